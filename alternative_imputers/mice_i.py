@@ -1,16 +1,104 @@
+import os
 from time import time
 from tqdm import tqdm
+from joblib import Parallel, delayed
 import numpy as np
 import pandas as pd
 import lightgbm as lgb
-from pandas.api.types import is_categorical_dtype, is_numeric_dtype
-from sklearn.metrics import mean_squared_error
+from pandas.api.types import is_numeric_dtype
+
+
+def encode_once(df):
+    """Encodes a DataFrame into a single dense matrix for LightGBM.
+    
+    Numeric columns are copied as they are, the other columns are replaced by 
+    their category codes. Missing values stay nans, LightGBM handles them natively. 
+    The columns keep their position, all the numeric ones are converted in one block.
+    
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Input data.
+        
+    Returns
+    -------
+    numpy.ndarray
+        Encoded float32 matrix of shape (n_rows, n_columns).
+    dict
+        Maps the index of each categorical column to its categories.
+    """
+    is_numeric = np.array([is_numeric_dtype(dtype) for dtype in df.dtypes])
+    num_ids, cat_ids = np.flatnonzero(is_numeric), np.flatnonzero(~is_numeric)
+    
+    res = np.empty(df.shape, dtype=np.float32)
+    res[:, num_ids] = df.iloc[:, num_ids].to_numpy(dtype=np.float32)
+    col_categories = {}
+    if len(cat_ids) > 0:
+        cat_columns = [df.iloc[:, col_id] for col_id in cat_ids]
+        cat_columns = [col if isinstance(col.dtype, pd.CategoricalDtype) else col.astype("category") 
+                       for col in cat_columns]
+        cat_mat = np.column_stack([col.cat.codes.to_numpy(dtype=np.int32) for col in cat_columns])
+        res[:, cat_ids] = np.where(cat_mat < 0, np.nan, cat_mat)
+        col_categories = {col_id: col.cat.categories for col_id, col in zip(cat_ids.tolist(), cat_columns)}
+    return res, col_categories
+
+
+def build_col_to_rows(nan_ids, n_cols):
+    """Groups the rows of the missing values by column, in CSR layout.
+    
+    Parameters
+    ----------
+    nan_ids : array-like, shape (n_nans, 2)
+        Row and column indices of the missing values.
+    n_cols : int
+        Number of columns of the DataFrame.
+        
+    Returns
+    -------
+    numpy.ndarray
+        Offsets of shape (n_cols + 1,): the missing rows of the column ``j`` 
+        are ``rows[offsets[j]:offsets[j + 1]]``.
+    numpy.ndarray
+        Rows of the missing values sorted by column.
+    """
+    nan_ids = np.asarray(nan_ids, dtype=np.int64).reshape(-1, 2)
+    offsets = np.zeros(n_cols + 1, dtype=np.int64)
+    np.cumsum(np.bincount(nan_ids[:, 1], minlength=n_cols), out=offsets[1:])
+    rows = nan_ids[np.argsort(nan_ids[:, 1], kind="stable"), 0]
+    return offsets, rows
+
 
 class BaseMICE:
-    """Base class for the MICE implementation."""
+    """Base class for the MICE implementation.
+    
+    The LightGBM model of each column is warm-started across the iterations: the 
+    first fit has ``n_estimators`` boosting rounds and every later one adds 
+    ``n_warm_estimators`` rounds, so the models (and their prediction cost) grow 
+    with ``max_iter``. If ``max_estimators`` is given, a model that would exceed 
+    it is dropped and the column is fitted again from scratch, which resets its 
+    number of rounds to ``n_estimators`` in the middle of the run.
+    
+    Parameters
+    ----------
+    max_iter : int
+        Number of MICE iterations.
+    max_estimators : int, optional
+        Maximum number of boosting rounds of a warm-started model, no limit by default.
+    """
     
-    def __init__(self, max_iter=10):
+    n_estimators = 50
+    n_warm_estimators = 10
+    
+    def __init__(self, max_iter=10, max_estimators=None):
         self.max_iter = max_iter
+        self.max_estimators = max_estimators
+        self._dataset_cache = {}
+        self._boosters = {}
+    
+    def reset_cache(self):
+        """Forgets the LightGBM datasets and boosters cached for the previous DataFrame."""
+        self._dataset_cache = {}
+        self._boosters = {}
     
     def fill_missing_values(self, df):
         """Fills the missing values of a pandas DataFrame.
@@ -25,11 +113,13 @@ class BaseMICE:
         pandas.DataFrame
             DataFrame with imputed missing values.
         """
-        nan_ids = np.argwhere(df.isna().values).tolist()
-        df_imputed = self.impute_initial_mean_or_mode(df)
-        iter_results = []
+        if not df.isna().any().any():
+            return self.convert_categorical(df)
+        self.reset_cache()
+        col_to_rows = self.get_col_to_rows(df)
+        df_imputed = self.convert_categorical(df)
         for iter in range(self.max_iter):
-            df_imputed = self.transform(df_imputed, nan_ids, iter)
+            df_imputed = self.transform(df_imputed, col_to_rows, iter)
         return df_imputed
     
     def benchmark(self, df_original, df_missing, drop_columns_loss=None):
@@ -50,22 +140,23 @@ class BaseMICE:
         pandas.DataFrame
             DataFrame with imputed missing values.
         """
-        columns_missing = df_missing.isna().sum()
-        columns_missing = columns_missing[columns_missing > 0]
-        nan_ids = np.argwhere(df_missing.isna().values).tolist()
-        df_imputed = self.impute_initial_mean_or_mode(df_missing)
-        self.df_mean = df_imputed.copy()
+        self.reset_cache()
+        col_to_rows = self.get_col_to_rows(df_missing)
+        self.df_mean = self.impute_initial_mean_or_mode(df_missing)
+        df_imputed = self.convert_categorical(df_missing)
+        
+        # The original data is encoded only once
+        loss_columns = df_original.columns.drop(drop_columns_loss) if drop_columns_loss else df_original.columns
+        loss_categories = self.get_loss_categories(df_original[loss_columns])
+        original_np = self.encode_loss(df_original[loss_columns], loss_categories)
         
         iter_results = []
         for iter in range(self.max_iter):
             time_start = time()
-            df_imputed = self.transform(df_imputed, columns_missing, nan_ids, iter)
+            df_imputed = self.transform(df_imputed, col_to_rows, iter)
             time_stop = time() - time_start
-            if drop_columns_loss:
-                loss = self.compute_loss(df_original.drop(columns=drop_columns_loss, axis=1), 
-                                         df_imputed.drop(columns=drop_columns_loss, axis=1))
-            else:
-                loss = self.compute_loss(df_original, df_imputed)
+            filled_np = self.encode_loss(df_imputed[loss_columns], loss_categories)
+            loss = float(np.mean((original_np - filled_np) ** 2))
             iter_results.append({
                 "iter": iter,
                 "time_seconds": time_stop, 
@@ -79,126 +170,277 @@ class BaseMICE:
         df_imputed = self.impute_initial_mean_or_mode(df_missing)
         time_stop = time() - time_start
         
-        iter_results = []
-        for iter in range(self.max_iter):
-            if drop_columns_loss:
-                loss = self.compute_loss(df_original.drop(columns=drop_columns_loss, axis=1), 
-                                         df_imputed.drop(columns=drop_columns_loss, axis=1))
-            else:
-                loss = self.compute_loss(df_original, df_imputed)
-            iter_results.append({
-                "iter": iter,
-                "time_seconds": time_stop, 
-                "loss": loss
-            })
-        return iter_results
+        # The imputation does not change between iterations, neither does the loss
+        if drop_columns_loss:
+            loss = self.compute_loss(df_original.drop(columns=drop_columns_loss, axis=1), 
+                                     df_imputed.drop(columns=drop_columns_loss, axis=1))
+        else:
+            loss = self.compute_loss(df_original, df_imputed)
+        return [{
+            "iter": iter,
+            "time_seconds": time_stop if iter == 0 else 0.0, 
+            "loss": loss
+        } for iter in range(self.max_iter)]
     
-    def get_model(self, target):
-        if is_numeric_dtype(target):
-            model = lgb.LGBMRegressor()
+    def get_col_to_rows(self, df):
+        """Maps the index of each column with missing values to the rows of its missing values."""
+        offsets, rows = build_col_to_rows(np.argwhere(df.isna().to_numpy()), df.shape[1])
+        return {col_id: rows[offsets[col_id]:offsets[col_id + 1]] 
+                for col_id in np.flatnonzero(np.diff(offsets)).tolist()}
+    
+    def get_params(self, n_classes=None):
+        """LightGBM parameters for a numeric target or a target with ``n_classes`` classes.
+        
+        The models are small and refitted many times on similar data, so the trees 
+        are kept shallow and the datasets are not pre-filtered, to be reusable.
+        """
+        params = {
+            "num_leaves": 15,
+            "learning_rate": 0.1,
+            "min_data_in_leaf": 20,
+            "num_threads": os.cpu_count(),
+            "force_row_wise": True,
+            "feature_pre_filter": False,
+            "verbose": -1,
+        }
+        if n_classes is None:
+            params["objective"] = "regression"
+        elif n_classes == 2:
+            params["objective"] = "binary"
         else:
-            model = lgb.LGBMClassifier()
-        return model
+            params.update(objective="multiclass", num_class=n_classes)
+        return params
+    
+    def fit_predict(self, col_id, X_train, y_train, X_pred, categorical_feature, n_classes=None):
+        """Fits a LightGBM model on the observed values of a column and predicts the missing ones.
+        
+        The bin mappers of the first dataset built for a column are cached and 
+        reused by the later fits of the same column, only the feature values change. 
+        The later fits also warm-start from the previous booster of the column and 
+        only add ``n_warm_estimators`` boosting rounds. If ``max_estimators`` is set, 
+        a booster that would exceed it is dropped and the column is fitted from scratch, 
+        which bounds the prediction cost and forgets the rounds fitted in the first 
+        iteration, where the features of the other columns still contain their nans.
+        
+        Parameters
+        ----------
+        col_id : int
+            Index of the target column.
+        X_train : numpy.ndarray
+            Features of the rows where the target is observed.
+        y_train : numpy.ndarray
+            Observed values (or category codes) of the target.
+        X_pred : numpy.ndarray
+            Features of the rows where the target is missing.
+        categorical_feature : list
+            Indices of the categorical features.
+        n_classes : int, optional
+            Number of categories of a categorical target.
+            
+        Returns
+        -------
+        numpy.ndarray
+            Predicted values (or category codes) of the target.
+        """
+        if n_classes == 1:
+            return np.zeros(len(X_pred), dtype=int)
+        
+        # LightGBM works in float32 internally, both the features and the labels
+        X_train = np.ascontiguousarray(X_train, dtype=np.float32)
+        y_train = np.asarray(y_train, dtype=np.float32)
+        dset = lgb.Dataset(X_train, label=y_train, categorical_feature=categorical_feature, 
+                           reference=self._dataset_cache.get(col_id))
+        init_model = self._boosters.get(col_id)
+        if (init_model is not None and self.max_estimators is not None 
+                and init_model.current_iteration() + self.n_warm_estimators > self.max_estimators):
+            init_model = None
+        booster = lgb.train(self.get_params(n_classes), dset, init_model=init_model,
+                            num_boost_round=self.n_estimators if init_model is None else self.n_warm_estimators)
+        self._dataset_cache.setdefault(col_id, dset)
+        self._boosters[col_id] = booster
+        
+        # Predict directly on a contiguous float32 matrix, no conversion on LightGBM's side
+        pred = booster.predict(np.ascontiguousarray(X_pred, dtype=np.float32))
+        if n_classes is None:
+            return pred
+        elif n_classes == 2:
+            return (pred > 0.5).astype(int)
+        else:
+            return pred.argmax(axis=1)
+    
+    def predict_column(self, df, X_full, col_categories, col_id, rows_missing):
+        """Predicts the missing rows of a column from the encoded matrix ``X_full`` of ``df``."""
+        X = np.delete(X_full, col_id, axis=1)
+        categorical_feature = [i - (i > col_id) for i in col_categories if i != col_id]
+        observed_mask = np.ones(len(df), dtype=bool)
+        observed_mask[rows_missing] = False
+        if col_id in col_categories:
+            y, n_classes = X_full[:, col_id], len(col_categories[col_id])
+        else:
+            y, n_classes = df.iloc[:, col_id].to_numpy(dtype=np.float32), None
+        
+        return self.fit_predict(col_id, X[observed_mask], y[observed_mask], X[rows_missing], 
+                                categorical_feature, n_classes)
+    
+    def write_column(self, df, col_categories, col_id, rows_missing, values):
+        """Writes the predicted values of a column in ``df``, replacing the whole column at once."""
+        column = df.iloc[:, col_id]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes = column.cat.codes.to_numpy(copy=True)
+            codes[rows_missing] = values
+            df.isetitem(col_id, pd.Categorical.from_codes(codes, dtype=column.dtype))
+        else:
+            column = column.to_numpy(copy=True)
+            column[rows_missing] = col_categories[col_id][values] if col_id in col_categories else values
+            df.isetitem(col_id, column)
     
     def compute_loss(self, original_df, filled_df):
-        """Computes the difference between the original and filled DataFrames."""
-        return mean_squared_error(original_df, filled_df)
+        """Computes the difference (MSE) between the original and filled DataFrames."""
+        loss_categories = self.get_loss_categories(original_df)
+        original_np = self.encode_loss(original_df, loss_categories)
+        filled_np = self.encode_loss(filled_df, loss_categories)
+        return float(np.mean((original_np - filled_np) ** 2))
     
-    def impute_initial_mean_or_mode(self, df):
-        df_new = df.copy()
-        for column in df:
-            if is_numeric_dtype(df[column]):
-                df_new[column] = df_new[column].fillna(df_new[column].mean())
+    def get_loss_categories(self, df):
+        """Categories used to label-encode the non-numeric columns when computing the loss."""
+        return {column: pd.Categorical(df[column]).categories for column in df if not is_numeric_dtype(df[column])}
+    
+    def encode_loss(self, df, loss_categories):
+        """Float64 matrix of a DataFrame for computing the loss, the non-numeric columns are label-encoded."""
+        res = np.empty(df.shape)
+        for col_id, column in enumerate(df):
+            if column in loss_categories:
+                res[:, col_id] = pd.Categorical(df[column], categories=loss_categories[column]).codes
             else:
-                df_new[column] = df_new[column].fillna(df_new[column].mode())
-        return df_new
+                res[:, col_id] = df[column].to_numpy()
+        return res
+    
+    def convert_categorical(self, df):
+        """Converts the non-numeric columns to pandas categoricals, returns a new DataFrame."""
+        return df.astype({column: "category" for column in df if not is_numeric_dtype(df[column])})
+    
+    def impute_initial_mean_or_mode(self, df):
+        """Fills the missing values with the mean of the numeric columns and the mode of the other ones."""
+        # Only the columns with missing values are filled, the others are left untouched
+        missing_columns = df.columns[df.isna().any().to_numpy()]
+        numeric_columns = df[missing_columns].select_dtypes(include="number").columns
+        fill_values = df[numeric_columns].mean().to_dict()
+        for column in missing_columns.difference(numeric_columns):
+            mode = df[column].mode()
+            if len(mode) > 0:
+                fill_values[column] = mode.iloc[0]
+        return df.fillna(fill_values)
     
-    def transform(self, df, nan_ids):
+    def transform(self, df, col_to_rows, iter_id):
         pass
 
 
 class VanilaMICE(BaseMICE):
-    """MICE implementation using value by value imputation."""
+    """MICE implementation imputing the columns sequentially, each column is 
+    predicted from the values already imputed for the previous ones."""
     
     method_name = "Vanila MICE"
     
-    def transform(self, df: pd.DataFrame, columns_missing: list, nan_ids: list, iter_id: int):
-        random_ids = np.random.permutation(len(nan_ids)).tolist()
-        for id in tqdm(random_ids, desc=f"{self.method_name}: Iter {iter_id + 1} / {self.max_iter}", position=0):
-            # Setup data
-            row_id, col_id = nan_ids[id]
-            target_column_name = df.columns[col_id]
-            X = df.drop(columns=[target_column_name], axis=1)
-            X = pd.get_dummies(X, drop_first=True)
-            y = df[target_column_name]
-            
-            # Fit model
-            model = self.get_model(y).fit(X.drop(index=row_id), y.drop(index=row_id))
-            
-            # Predict value
-            df.iloc[row_id, col_id] = model.predict(X.iloc[row_id:row_id + 1, :])
+    def transform(self, df: pd.DataFrame, col_to_rows: dict, iter_id: int):
+        if not col_to_rows:
+            return df
+        # Encode once per iteration, the matrix is kept in sync with the imputed values
+        X_full, col_categories = encode_once(df)
+        
+        # Visit the missing columns in random order, one model per column visit; 
+        # df is only updated once all the columns are imputed
+        col_order = np.random.permutation(list(col_to_rows)).tolist()
+        predictions = {}
+        for col_id in tqdm(col_order, desc=f"{self.method_name}: Iter {iter_id + 1} / {self.max_iter}", position=0):
+            rows_missing = col_to_rows[col_id]
+            values = self.predict_column(df, X_full, col_categories, col_id, rows_missing)
+            X_full[rows_missing, col_id] = values
+            predictions[col_id] = (rows_missing, values)
+        
+        for col_id, (rows_missing, values) in predictions.items():
+            self.write_column(df, col_categories, col_id, rows_missing, values)
         return df
 
 
 class FastMICE(BaseMICE):
-    """MICE implementation using column by column imputation."""
+    """MICE implementation imputing all the columns in parallel from the same 
+    snapshot of the data."""
     
     method_name = "Fast MICE"
     
-    def transform(self, df: pd.DataFrame, columns_missing: list, nan_ids: list, iter_id: int):
-        random_ids = np.random.permutation(len(nan_ids)).tolist()
-        for column_id in tqdm(random_ids, desc=f"{self.method_name}: Iter {iter_id + 1} / {self.max_iter}", position=0):
-            
-            row_id, col_id = nan_ids[id]
-            target_column_name = df.columns[col_id]
-            X = df.drop(columns=[target_column_name], axis=1)
-            X = pd.get_dummies(X, drop_first=True)
-            y = df[target_column_name]
-            column_nan_ids = [id[0] for id in nan_ids if id[1] == column_id]
-            
-            # Fit model
-            model = self.get_model(y).fit(X.drop(index=column_nan_ids), y.drop(index=column_nan_ids))
-            
-            # Predict value
-            df.iloc[column_nan_ids, column_id] = model.predict(X.iloc[column_nan_ids, :])
+    def __init__(self, max_iter=10, n_jobs=-1, max_estimators=None):
+        super().__init__(max_iter, max_estimators)
+        self.n_jobs = n_jobs
+    
+    def get_params(self, n_classes=None):
+        params = super().get_params(n_classes)
+        if self.n_jobs != 1:
+            # The columns are already fitted in parallel
+            params["num_threads"] = 1
+        return params
+    
+    def transform(self, df: pd.DataFrame, col_to_rows: dict, iter_id: int):
+        if not col_to_rows:
+            return df
+        order = np.random.permutation(list(col_to_rows)).tolist()
+        # All the columns are fitted on the same snapshot of the data, so the fits are 
+        # independent and run in parallel; the predictions are written afterwards
+        X_full, col_categories = encode_once(df)
+        # The progress bar follows the finished fits, not the dispatched ones
+        results = Parallel(n_jobs=self.n_jobs, prefer="threads", return_as="generator")(
+            delayed(self.predict_column)(df, X_full, col_categories, col_id, col_to_rows[col_id])
+            for col_id in order
+        )
+        predictions = list(tqdm(results, total=len(order), 
+                                desc=f"{self.method_name}: Iter {iter_id + 1} / {self.max_iter}", position=0))
+        for col_id, values in zip(order, predictions):
+            self.write_column(df, col_categories, col_id, col_to_rows[col_id], values)
         return df
 
 
 class SlowFastMICE(BaseMICE):
-    """MICE implementation using value-by-value imputation in the first iteration 
-    and column-by-column for the remaining iterations."""
+    """MICE implementation using sequential column-by-column imputation (VanilaMICE) 
+    in the first iteration and parallel imputation (FastMICE) for the remaining iterations."""
     
     method_name = "Slow-Fast MICE"
     
-    def __init__(self, max_iter=10):
+    def __init__(self, max_iter=10, max_estimators=None):
         self.max_iter = max_iter
-        self.vanila_mice = VanilaMICE(self.max_iter)
+        self.vanila_mice = VanilaMICE(self.max_iter, max_estimators)
         self.vanila_mice.method_name = self.method_name
-        self.fast_mice = FastMICE(self.max_iter)
+        self.fast_mice = FastMICE(self.max_iter, max_estimators=max_estimators)
         self.fast_mice.method_name = self.method_name
     
-    def transform(self, df: pd.DataFrame, columns_missing: list, nan_ids: list, iter_id: int):
+    def reset_cache(self):
+        self.vanila_mice.reset_cache()
+        self.fast_mice.reset_cache()
+    
+    def transform(self, df: pd.DataFrame, col_to_rows: dict, iter_id: int):
         if iter_id > 0:
-            return self.fast_mice.transform(df, columns_missing, nan_ids, iter_id)
+            return self.fast_mice.transform(df, col_to_rows, iter_id)
         else:
-            return self.vanila_mice.transform(df, columns_missing, nan_ids, iter_id)
+            return self.vanila_mice.transform(df, col_to_rows, iter_id)
         
 
 class FastSlowMICE(BaseMICE):
-    """MICE implementation using column-by-column imputation in all but one iterations
-    and value-by-value for the last iteration."""
+    """MICE implementation using parallel imputation (FastMICE) in all but one iterations
+    and sequential column-by-column imputation (VanilaMICE) for the last iteration."""
     
     method_name = "Fast-Slow MICE"
     
-    def __init__(self, max_iter=10):
+    def __init__(self, max_iter=10, max_estimators=None):
         self.max_iter = max_iter
-        self.vanila_mice = VanilaMICE(self.max_iter)
+        self.vanila_mice = VanilaMICE(self.max_iter, max_estimators)
         self.vanila_mice.method_name = self.method_name
-        self.fast_mice = FastMICE(self.max_iter)
+        self.fast_mice = FastMICE(self.max_iter, max_estimators=max_estimators)
         self.fast_mice.method_name = self.method_name
     
-    def transform(self, df: pd.DataFrame, columns_missing: list, nan_ids: list, iter_id: int):
+    def reset_cache(self):
+        self.vanila_mice.reset_cache()
+        self.fast_mice.reset_cache()
+    
+    def transform(self, df: pd.DataFrame, col_to_rows: dict, iter_id: int):
         if iter_id + 1 == self.max_iter:
-            return self.vanila_mice.transform(df, columns_missing, nan_ids, iter_id)
+            return self.vanila_mice.transform(df, col_to_rows, iter_id)
         else:
-            return self.fast_mice.transform(df, columns_missing, nan_ids, iter_id)
\ No newline at end of file
+            return self.fast_mice.transform(df, col_to_rows, iter_id)
\ No newline at end of file
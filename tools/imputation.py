@@ -60,12 +60,11 @@ def impute(X_miss, imputer_name = 'mf', frame=False, is_multiple_imputation=Fals
     elif name == 'mice_i':
         vm = mice_i.VanilaMICE(max_iter=5)
         vmices = []
-        mask = np.isnan(X_miss)
+        col_to_rows = vm.get_col_to_rows(pd.DataFrame(X_miss))
         for i in range(5):
-            mask_col = np.where(mask)[0]
-            mask_row = np.where(mask)[1]
-            ids = [[row, col] for row, col in zip(np.where(mask)[0],np.where(mask)[1]) ]
-            vmice = vm.transform(pd.DataFrame(X_miss),columns_missing = np.unique(mask_row), nan_ids = ids, iter_id=i)
+            # Each draw starts from fresh models, the draws stay independent
+            vm.reset_cache()
+            vmice = vm.transform(pd.DataFrame(X_miss), col_to_rows = col_to_rows, iter_id=i)
             vmices.append(vmice)
         vmices = np.array(vmices)
         imp = np.mean(vmices)